@@ -7,21 +7,44 @@ import socket
 import time
 import os
 import logging
+import logging.handlers
 import threading
+import collections
 import queue
-import re
-
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='matlab_controller.log',
-    filemode='a'
-)
+
+# Configurar logging: los registros se encolan en memoria y un
+# QueueListener en segundo plano hace el write() a disco, fuera del
+# camino de envío de comandos
+_log_queue = queue.SimpleQueue()
+_file_handler = logging.FileHandler('matlab_controller.log', mode='a')
+_file_handler.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logger = logging.getLogger('matlab_controller')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, _file_handler)
+_log_listener.start()
+
+# Socket Unix por usuario que publica el servidor; None si la plataforma
+# no soporta AF_UNIX (en ese caso se usa TCP)
+_SOCKET_PATH = ('/tmp/vim-matlab-{}.sock'.format(os.getuid())
+                if hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid')
+                else None)
+
+# Prefijos del protocolo pre-codificados una sola vez
+_RUN_FILE_PREFIX = b"run_file:"
+_RUN_CELL_PREFIX = b"run_cell:"
+_CANCEL_MSG = b"cancel\n"
+# Hueco de 4 bytes que reserva el prefijo de longitud al frente del búfer;
+# _seal_frame lo rellena una vez montado el mensaje
+_FRAME_HEADER = b"\x00\x00\x00\x00"
+_CANCEL_FRAME = len(_CANCEL_MSG).to_bytes(4, 'big') + _CANCEL_MSG
+
 
-# Cola para enviar comandos
-command_queue = queue.Queue()
+def _seal_frame(buf):
+    """Escribe la longitud del payload en los 4 bytes reservados."""
+    buf[:4] = (len(buf) - 4).to_bytes(4, 'big')
+    return buf
 
 
 class MatlabCliController:
@@ -31,6 +54,14 @@ class MatlabCliController:
         self.sock = None
         self.connected = False
         self.connect_lock = threading.Lock()
+        # Lock corto que serializa las escrituras crudas al socket
+        self._send_lock = threading.Lock()
+        # Búfer de envío reutilizable para no crear bytes nuevos por comando
+        self._buf = bytearray(8192)
+        # Cola propia de la instancia: deque.append/popleft son atómicos en
+        # CPython, así que los productores no compiten por ningún lock
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
         self.connect_to_server()
         
         # Iniciar un hilo para procesar comandos
@@ -40,35 +71,110 @@ class MatlabCliController:
         """Inicia un hilo para procesar comandos de la cola."""
         def process_commands():
             while True:
+                # Espera bloqueante: el hilo duerme hasta que hay comandos
+                self._wakeup.wait()
+                self._wakeup.clear()
+                # Drenar todo lo pendiente de una vez para poder agrupar
+                # comandos consecutivos en un solo envío
+                items = []
+                while True:
+                    try:
+                        items.append(self._queue.popleft())
+                    except IndexError:
+                        break
+                if not items:
+                    continue
                 try:
-                    command, args = command_queue.get(timeout=0.5)
-                    if command == 'run_code':
-                        self._send_code(args)
-                    elif command == 'run_file':
-                        self._send_run_file(args)
-                    elif command == 'run_cell':
-                        self._send_cell(args)
-                    elif command == 'ctrl_c':
-                        self._send_ctrl_c()
-                    command_queue.task_done()
-                except queue.Empty:
-                    time.sleep(0.01)  # Pequeña pausa cuando no hay comandos
+                    self._process_batch(items)
                 except Exception as ex:
-                    logger.error(f"Error processing command: {ex}")
+                    logger.error("Error processing command: %s", ex)
                     time.sleep(0.1)  # Pausa en caso de error
+                if None in items:
+                    # Centinela de cierre enviado desde close()
+                    break
         
         # Iniciar hilo
         cmd_thread = threading.Thread(target=process_commands)
         cmd_thread.daemon = True
         cmd_thread.start()
 
+    # Tamaño máximo de un lote agrupado en un solo sendall
+    _MAX_BATCH = 64 * 1024
+
+    def _enqueue(self, item):
+        """Encola un comando y despierta al hilo procesador.
+
+        Primero el append y después la señal: decidir por el estado de la
+        cola antes de encolar pierde el despertar si el procesador la
+        vació y se durmió entre ambas operaciones. El is_set solo ahorra
+        el set redundante en ráfagas; con el Event ya señalado el
+        procesador aún no ha hecho clear y drenará este elemento.
+        """
+        self._queue.append(item)
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def _process_batch(self, items):
+        """Procesa un lote drenado de la cola, agrupando códigos consecutivos."""
+        pending_code = None
+        for item in items:
+            if item is None:
+                continue
+            command, args = item
+            if command == 'run_code':
+                # Acumular códigos consecutivos y enviarlos juntos
+                if pending_code is None:
+                    pending_code = args
+                elif len(pending_code) < self._MAX_BATCH:
+                    pending_code = pending_code.rstrip('\n') + '\n' + args
+                else:
+                    self._send_code(pending_code)
+                    pending_code = args
+                continue
+            if pending_code is not None:
+                self._send_code(pending_code)
+                pending_code = None
+            if command == 'run_file':
+                self._send_run_file(args)
+            elif command == 'run_cell':
+                self._send_cell(args)
+        if pending_code is not None:
+            self._send_code(pending_code)
+
+    @staticmethod
+    def _tune_socket(sock):
+        """Búferes de 1 MB para que una celda grande salga en un solo write."""
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+
     def connect_to_server(self):
         """Connect to the Matlab server."""
         with self.connect_lock:
             if self.connected:
                 return True
-                
+
+            # Preferir el socket Unix local: evita la pila TCP/IP completa
+            # para la IPC en la misma máquina
+            if _SOCKET_PATH is not None and os.path.exists(_SOCKET_PATH):
+                try:
+                    self.sock = socket.socket(socket.AF_UNIX,
+                                              socket.SOCK_STREAM)
+                    self._tune_socket(self.sock)
+                    self.sock.connect(_SOCKET_PATH)
+                    self.connected = True
+                    logger.info("Connected to Matlab server (Unix socket)")
+                    print("Connected to Matlab server")
+                    return True
+                except socket.error as e:
+                    logger.warning("Unix socket connect failed: %s", e)
+                    self.sock = None
+
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._tune_socket(self.sock)
+            # Deshabilitar Nagle: los comandos son pequeños y la latencia importa
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Detectar un servidor muerto sin esperas indefinidas
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             try:
                 self.sock.connect((self.host, self.port))
                 self.connected = True
@@ -77,7 +183,7 @@ class MatlabCliController:
                 return True
             except socket.error as e:
                 self.connected = False
-                logger.error(f"Failed to connect to Matlab server: {e}")
+                logger.error("Failed to connect to Matlab server: %s", e)
                 print(f"Failed to connect to Matlab server: {e}")
                 print("Make sure the server is running with: python matlab_server.py")
                 return False
@@ -90,11 +196,19 @@ class MatlabCliController:
             code = str(lines)
         
         # Encolar el comando
-        command_queue.put(('run_code', code))
-        logger.info(f"Enqueued code: {code[:50]}...")
+        self._enqueue(('run_code', code))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Enqueued code: %.50s...", code)
 
-    def _send_code(self, code):
-        """Envía código a MATLAB (método interno)."""
+    def _raw_send(self, frame):
+        """Envía un frame ya montado al servidor con reconexión y reintentos.
+
+        Único punto por el que pasan todas las escrituras al socket; cambiar
+        el transporte solo requiere tocar este método. El llamador entrega
+        el mensaje con su prefijo de longitud de 4 bytes big-endian ya
+        escrito (los _send_* lo sellan en el búfer reutilizable con
+        _seal_frame), así que aquí no se crea ninguna copia del payload.
+        """
         num_retry = 0
         while num_retry < 3:
             try:
@@ -102,33 +216,39 @@ class MatlabCliController:
                     num_retry += 1
                     time.sleep(0.2)
                     continue
-                
-                # Asegurar que termina con salto de línea
-                if not code.endswith("\n"):
-                    code += "\n"
-                
-                self.sock.sendall(code.encode('utf-8'))
-                logger.info(f"Sent to Matlab: {code[:50]}...")
-                break
+
+                with self._send_lock:
+                    self.sock.sendall(frame)
+                return True
             except Exception as ex:
-                logger.error(f"Error sending code to Matlab: {ex}")
+                logger.error("Error sending to Matlab: %s", ex)
                 self.connected = False
                 if not self.connect_to_server():
                     time.sleep(0.2)
                 num_retry += 1
+        return False
+
+    def _send_code(self, code):
+        """Envía código a MATLAB (método interno)."""
+        # Reutilizar el búfer de envío en lugar de crear un bytes por llamada
+        buf = self._buf
+        del buf[:]
+        buf += _FRAME_HEADER
+        buf += code.encode('utf-8')
+        if not buf.endswith(b'\n'):
+            buf.append(0x0A)
+
+        if self._raw_send(_seal_frame(buf)):
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Sent to Matlab: %.50s...", code)
 
     def run_cell(self, cell_content):
         """Run a Matlab cell (code block starting with %%)."""
-        # CORRECCIÓN: Procesar adecuadamente el contenido de la celda
-        lines = cell_content.split('\n')
-        
-        # Filtrar líneas vacías y comentarios de celda
-        cleaned_lines = []
-        for line in lines:
-            # Omitir líneas de celda %%
-            if line.strip() and not re.match(r'^\s*%%', line):
-                cleaned_lines.append(line)
-        
+        # Filtrar líneas vacías y marcadores de celda %%; str.startswith es
+        # una sola llamada en C frente al motor de re por línea
+        cleaned_lines = [line for line in cell_content.split('\n')
+                         if line.strip() and not line.lstrip().startswith('%%')]
+
         if not cleaned_lines:
             logger.warning("Cell is empty after removing comments")
             print("Cell is empty after removing comments")
@@ -136,35 +256,24 @@ class MatlabCliController:
         
         # Unir las líneas procesadas y enviar como contenido de celda
         code = '\n'.join(cleaned_lines)
-        command_queue.put(('run_cell', code))
-        logger.info(f"Enqueued cell: {code[:50]}...")
+        self._enqueue(('run_cell', code))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Enqueued cell: %.50s...", code)
 
     def _send_cell(self, cell_content):
         """Envía una celda de código a MATLAB (método interno)."""
-        # CORRECCIÓN: Asegurar que se envía correctamente el contenido de la celda
         # El servidor debe recibir un mensaje identificable como celda
-        command = f"run_cell:{cell_content}"
-        num_retry = 0
-        while num_retry < 3:
-            try:
-                if not self.connected and not self.connect_to_server():
-                    num_retry += 1
-                    time.sleep(0.2)
-                    continue
-                
-                # Asegurar que termina con salto de línea
-                if not command.endswith("\n"):
-                    command += "\n"
-                    
-                self.sock.sendall(command.encode('utf-8'))
-                logger.info(f"Sent cell to Matlab: {cell_content[:50]}...")
-                break
-            except Exception as ex:
-                logger.error(f"Error sending cell to Matlab: {ex}")
-                self.connected = False
-                if not self.connect_to_server():
-                    time.sleep(0.2)
-                num_retry += 1
+        buf = self._buf
+        del buf[:]
+        buf += _FRAME_HEADER
+        buf += _RUN_CELL_PREFIX
+        buf += cell_content.encode('utf-8')
+        if not buf.endswith(b'\n'):
+            buf.append(0x0A)
+
+        if self._raw_send(_seal_frame(buf)):
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Sent cell to Matlab: %.50s...", cell_content)
 
     def run_file(self, filepath):
         """Run a complete MATLAB file."""
@@ -172,39 +281,24 @@ class MatlabCliController:
         filepath = os.path.abspath(filepath)  # Convertir a ruta absoluta
         
         if not os.path.exists(filepath):
-            logger.error(f"File not found: {filepath}")
+            logger.error("File not found: %s", filepath)
             print(f"Error: File not found: {filepath}")
             return
             
-        command_queue.put(('run_file', filepath))
-        logger.info(f"Enqueued run file: {filepath}")
+        self._enqueue(('run_file', filepath))
+        logger.info("Enqueued run file: %s", filepath)
 
     def _send_run_file(self, filepath):
         """Envía comando para ejecutar archivo (método interno)."""
-        # CORRECCIÓN: Asegurar que se envía correctamente la ruta del archivo
-        command = f"run_file:{filepath}"
-        
-        num_retry = 0
-        while num_retry < 3:
-            try:
-                if not self.connected and not self.connect_to_server():
-                    num_retry += 1
-                    time.sleep(0.2)
-                    continue
-                
-                # Asegurar que termina con salto de línea
-                if not command.endswith("\n"):
-                    command += "\n"
-                    
-                self.sock.sendall(command.encode('utf-8'))
-                logger.info(f"Sent run file command to Matlab: {filepath}")
-                break
-            except Exception as ex:
-                logger.error(f"Error sending run file command to Matlab: {ex}")
-                self.connected = False
-                if not self.connect_to_server():
-                    time.sleep(0.2)
-                num_retry += 1
+        buf = self._buf
+        del buf[:]
+        buf += _FRAME_HEADER
+        buf += _RUN_FILE_PREFIX
+        buf += filepath.encode('utf-8')
+        buf.append(0x0A)
+
+        if self._raw_send(_seal_frame(buf)):
+            logger.info("Sent run file command to Matlab: %s", filepath)
 
     def setup_matlab_path(self, path=None):
         """Add path to Matlab's path."""
@@ -213,7 +307,7 @@ class MatlabCliController:
             path = os.path.abspath(os.path.dirname(__file__))
             
         self.run_code([f"addpath('{path}');"])
-        logger.info(f"Added to Matlab path: {path}")
+        logger.info("Added to Matlab path: %s", path)
 
     def open_in_matlab_editor(self, path):
         """Open a file in Matlab editor."""
@@ -225,36 +319,43 @@ class MatlabCliController:
 
     def send_ctrl_c(self):
         """Send cancel command to Matlab."""
-        command_queue.put(('ctrl_c', None))
-        logger.info("Enqueued cancel command")
-
-    def _send_ctrl_c(self):
-        """Envía comando de cancelación (método interno)."""
-        try:
-            if not self.connected and not self.connect_to_server():
-                logger.error("Cannot send Ctrl+C: not connected")
-                return
-                
-            self.sock.sendall(b"cancel\n")
+        # El cancel no pasa por la cola: debe adelantar a cualquier código
+        # pendiente, no esperar detrás de él. El frame va pre-sellado a
+        # nivel de módulo: no cambia nunca
+        if self._raw_send(_CANCEL_FRAME):
             logger.info("Cancel command sent to Matlab")
-        except Exception as ex:
-            logger.error(f"Error sending cancel command: {ex}")
-            self.connected = False
+        else:
+            logger.error("Cannot send Ctrl+C: not connected")
         
     def close(self):
         """Close the connection to Matlab server."""
+        # Despertar y terminar el hilo procesador
+        self._enqueue(None)
         try:
             if self.sock:
                 self.sock.close()
                 self.connected = False
                 logger.info("Connection to Matlab server closed")
         except Exception as ex:
-            logger.error(f"Error closing connection: {ex}")
+            logger.error("Error closing connection: %s", ex)
+
+
+# Instancia compartida del proceso: los buffers de Vim reimportan este
+# módulo y no deben abrir un socket ni un hilo procesador cada vez
+_INSTANCE = None
+
+
+def get_controller():
+    """Devuelve el controlador único del proceso, creándolo si hace falta."""
+    global _INSTANCE
+    if _INSTANCE is None:
+        _INSTANCE = MatlabCliController()
+    return _INSTANCE
 
 
 # Example usage
 if __name__ == "__main__":
-    controller = MatlabCliController()
+    controller = get_controller()
     try:
         # Run a simple Matlab command
         controller.run_code(["disp('Hello from Matlab!');"])
@@ -5,26 +5,32 @@ Optimized Matlab Server for Vim
 This script launches Matlab and sets up a TCP server to communicate with Vim.
 """
 
-import socketserver
+import base64
+import selectors
+import socket
 import os
-import random
 import signal
-import string
 import sys
 import threading
 import time
 from sys import stdin
-import queue
+import collections
 import logging
+import logging.handlers
+import queue
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='matlab_server.log',
-    filemode='a'
-)
+# Setup logging: los hilos del servidor solo encolan los registros en
+# memoria; el write() a disco lo hace un QueueListener en segundo plano,
+# fuera del camino crítico de despacho de comandos
+_log_queue = queue.SimpleQueue()
+_file_handler = logging.FileHandler('matlab_server.log', mode='a')
+_file_handler.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logger = logging.getLogger('matlab_server')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, _file_handler)
+_log_listener.start()
 
 # Try to use pexpect for better interaction with Matlab
 try:
@@ -38,33 +44,135 @@ hide_until_newline = False
 auto_restart = True
 server = None
 
-# Cola de comandos para optimizar el envío de múltiples comandos
-command_queue = queue.Queue()
+# Socket Unix por usuario para IPC local: evita toda la pila TCP/IP.
+# None en plataformas sin AF_UNIX (se usa TCP como alternativa).
+_SOCKET_PATH = ('/tmp/vim-matlab-{}.sock'.format(os.getuid())
+                if hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid')
+                else None)
+
+# The maximum number of characters allowed on a single line in Matlab's CLI
+# is 4096; long commands must be split with line continuations.
+_SPLIT_DELIM = ' ...\n'
+_LINE_SIZE = 4095 - len(_SPLIT_DELIM)
+
+
+def _write_all(fd, data):
+    """Escribe todos los bytes en el fd, gestionando escrituras parciales."""
+    view = memoryview(data)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+def _rand_var_name():
+    """Nombre de variable Matlab aleatorio de 12 caracteres.
+
+    Una sola llamada a os.urandom + b32encode en lugar de 12 vueltas de
+    random.choice. Se antepone 'T' porque base32 puede empezar por dígito.
+    """
+    return 'T' + base64.b32encode(os.urandom(8)).decode('ascii')[:11]
 
 
 class Matlab:
     """Handles the Matlab process and communication."""
     def __init__(self):
+        # Inicializar explícitamente: kill() comprueba contra None en vez
+        # de pagar un hasattr en cada llamada. _proc_uses_tty y _stdin_fd
+        # también, para que un spawn fallido no deje el objeto sin los
+        # atributos que usan _prepare_command y _execute_command
+        self.proc = None
+        self._proc_uses_tty = use_pexpect
+        self._stdin_fd = None
         self.launch_process()
-        self.command_lock = threading.Lock()  # Lock para sincronizar acceso
+        # Deque propio de la instancia: append/popleft son atómicos en
+        # CPython, así que encolar no toma ningún lock; el Event despierta
+        # al hilo procesador sin sondeos
+        self._deque = collections.deque()
+        self._wakeup = threading.Event()
+        # Búfer de envío reutilizable: el lote se codifica dentro de este
+        # bytearray en lugar de crear un bytes nuevo por escritura
+        self._sendbuf = bytearray()
+        # Instante del último SIGINT enviado, para coalescer cancels
+        self._last_cancel = 0.0
+        # Lock corto sobre el stdin de Matlab: el hilo drenador y
+        # forward_input escriben al mismo fd, y con os.write sin búfer un
+        # lote > PIPE_BUF podría intercalarse con una línea reenviada
+        self._stdin_lock = threading.Lock()
         # Iniciar el procesador de comandos
         self._start_command_processor()
 
+    def _enqueue(self, command):
+        """Encola un comando (o el centinela None) y despierta al procesador.
+
+        Primero el append y después la señal: decidir por el estado del
+        deque antes de encolar pierde el despertar si el procesador lo
+        vació y se durmió entre ambas operaciones. El is_set solo ahorra
+        el set redundante en ráfagas; con el Event ya señalado el
+        procesador aún no ha hecho clear y drenará este elemento.
+        """
+        self._deque.append(command)
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
     def _start_command_processor(self):
         """Inicia un hilo para procesar comandos de la cola."""
         def process_commands():
-            while True:
-                try:
-                    command = command_queue.get(timeout=0.5)
-                    with self.command_lock:
-                        self._execute_command(command)
-                    command_queue.task_done()
-                except queue.Empty:
-                    time.sleep(0.01)  # Pequeña pausa cuando no hay comandos
-                except Exception as ex:
-                    logger.error(f"Error processing command: {ex}")
-                    time.sleep(0.1)  # Pausa en caso de error
-        
+            shutdown = False
+            # Backoff exponencial acotado tras un fallo de envío, de 0.2 s
+            # hasta un tope de 2 s, mientras el hilo monitor relanza Matlab
+            backoff = 0.2
+            while not shutdown:
+                # El hilo duerme hasta que llega un comando
+                self._wakeup.wait()
+                self._wakeup.clear()
+                while True:
+                    try:
+                        command = self._deque.popleft()
+                    except IndexError:
+                        break
+                    if command is None:
+                        # Centinela de cierre enviado al apagar el servidor
+                        shutdown = True
+                        break
+                    # Agrupar lo pendiente en una lista y unirlo con un solo
+                    # join: cada comando ya termina en '\n', así que todo el
+                    # lote sale en una única escritura a Matlab
+                    batch = [command]
+                    size = len(command)
+                    while size < 64 * 1024 and self._deque:
+                        extra = self._deque.popleft()
+                        if extra is None:
+                            shutdown = True
+                            break
+                        batch.append(extra)
+                        size += len(extra)
+                    if use_pexpect:
+                        # pexpect.send espera str
+                        payload = (batch[0] if len(batch) == 1
+                                   else ''.join(batch))
+                    else:
+                        # Codificar los fragmentos dentro del búfer
+                        # reutilizable; extender un bytearray no realoca
+                        # un bytes inmutable por fragmento
+                        buf = self._sendbuf
+                        del buf[:]
+                        for fragment in batch:
+                            buf += fragment.encode('utf-8')
+                        payload = buf
+                    try:
+                        self._execute_command(payload)
+                    except Exception as ex:
+                        logger.error("Error processing command: %s", ex)
+                        # Devolver el lote al frente de la cola y esperar:
+                        # el hilo monitor detecta la caída del proceso y
+                        # lo relanza, así este hilo nunca se bloquea en un
+                        # spawn de Matlab
+                        self._deque.extendleft(reversed(batch))
+                        time.sleep(backoff)
+                        backoff = min(backoff * 2, 2.0)
+                    else:
+                        backoff = 0.2
+
         # Iniciar hilo
         cmd_thread = threading.Thread(target=process_commands)
         cmd_thread.daemon = True
@@ -76,66 +184,110 @@ class Matlab:
         try:
             if use_pexpect:
                 self.proc = pexpect.spawn("matlab", ["-nosplash", "-nodesktop"])
+                # pexpect habla con Matlab por un pty: rige el límite de
+                # línea del editor interactivo
+                self._proc_uses_tty = True
             else:
+                # start_new_session crea el grupo de procesos (para killpg)
+                # sin preexec_fn, que bloquea el camino rápido posix_spawn
                 self.proc = Popen(["matlab", "-nosplash", "-nodesktop"], stdin=PIPE,
-                                close_fds=True, preexec_fn=os.setsid)
+                                close_fds=True, start_new_session=True)
+                # stdin por tubería: Matlab lo lee como flujo, sin límite
+                # de línea del tty
+                self._proc_uses_tty = False
+                # fd cacheado para escribir con os.write, sin pasar por el
+                # BufferedWriter (lock + memcpy + flush por envío)
+                self._stdin_fd = self.proc.stdin.fileno()
             logger.info("Matlab process started successfully")
             return self.proc
         except Exception as ex:
-            logger.error(f"Error launching Matlab process: {ex}")
+            logger.error("Error launching Matlab process: %s", ex)
             print_flush(f"Error launching Matlab: {ex}")
             return None
 
+    def wait_until_ready(self, timeout=5):
+        """Espera a que Matlab esté listo tras un (re)arranque.
+
+        Con pexpect se espera el prompt real. Por tubería no se captura
+        stdout, así que no hay nada que leer: solo se comprueba, como
+        mejor esfuerzo, que el proceso no haya muerto nada más arrancar.
+        """
+        try:
+            if use_pexpect:
+                self.proc.expect_exact('>> ', timeout=timeout)
+            elif self.proc is None or self.proc.poll() is not None:
+                logger.warning("Matlab process is not running")
+        except Exception as ex:
+            logger.warning("Matlab readiness probe failed: %s", ex)
+
     def cancel(self):
         """Send interrupt signal to Matlab."""
+        # Coalescer cancels en ráfaga (auto-repeat de la tecla en Vim):
+        # una señal cada 50 ms es suficiente
+        now = time.monotonic()
+        if now - self._last_cancel < 0.05:
+            return
+        self._last_cancel = now
+        # Descartar lo encolado y aún no enviado: no debe ejecutarse
+        # contra un Matlab recién interrumpido. Se vacía elemento a
+        # elemento para no tragarse el centinela None de cierre
+        sentinel = False
+        while True:
+            try:
+                if self._deque.popleft() is None:
+                    sentinel = True
+            except IndexError:
+                break
+        if sentinel:
+            self._enqueue(None)
         try:
             os.kill(self.proc.pid, signal.SIGINT)
             logger.info("Interrupt signal sent to Matlab")
         except Exception as ex:
-            logger.error(f"Error sending interrupt to Matlab: {ex}")
+            logger.error("Error sending interrupt to Matlab: %s", ex)
 
     def kill(self):
         """Kill the Matlab process."""
         try:
-            if hasattr(self, 'proc') and self.proc:
+            if self.proc is not None:
                 os.killpg(self.proc.pid, signal.SIGTERM)
                 logger.info("Matlab process terminated")
         except Exception as ex:
             # Silently ignore errors when killing non-existent process
-            logger.debug(f"Error killing Matlab process: {ex}")
+            logger.debug("Error killing Matlab process: %s", ex)
 
     def run_code(self, code, run_timer=True):
         """Encolar código para ejecutar en Matlab."""
         # Preparar el comando
         command = self._prepare_command(code, run_timer)
         # Encolar el comando
-        command_queue.put(command)
-        logger.info(f"Enqueued code: {code[:100]}...")
+        self._enqueue(command)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Enqueued code: %.100s...", code)
 
     def run_cell(self, cell_code):
         """Run a Matlab cell block."""
-        # Verificar si hay contenido para ejecutar
-        if not cell_code or cell_code.strip() == '':
+        # Verificar si hay contenido para ejecutar; lstrip una sola vez en
+        # lugar de encadenar strip/split/join sobre todo el cuerpo
+        stripped = cell_code.lstrip() if cell_code else ''
+        if not stripped:
             logger.warning("Empty cell content, nothing to execute")
             return
-            
-        # Eliminar los marcadores de celda %% si están presentes
-        if cell_code.strip().startswith('%%'):
-            lines = cell_code.split('\n')
-            if lines:
-                # Eliminar el marcador %% de la primera línea
-                first_line = lines[0].strip()
-                if first_line.startswith('%%'):
-                    clean_first = first_line[2:].lstrip()
-                    if clean_first:
-                        lines[0] = clean_first
-                    else:
-                        lines = lines[1:]
-            cell_code = '\n'.join(lines)
-        
+
+        # Eliminar el marcador de celda %% de la primera línea si está
+        # presente; partition evita trocear el resto del cuerpo
+        if stripped.startswith('%%'):
+            first_line, sep, rest = stripped.partition('\n')
+            clean_first = first_line[2:].strip()
+            if clean_first:
+                cell_code = clean_first + sep + rest
+            else:
+                cell_code = rest
+
         # Ejecutar como código normal pero sin timer para celdas
         self.run_code(cell_code, run_timer=False)
-        logger.info(f"Running cell: {cell_code[:100]}...")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Running cell: %.100s...", cell_code)
 
     def run_file(self, filepath):
         """Run a complete MATLAB file."""
@@ -144,7 +296,7 @@ class Matlab:
         
         # Verificar que el archivo existe
         if not os.path.exists(filepath):
-            logger.error(f"File not found: {filepath}")
+            logger.error("File not found: %s", filepath)
             print_flush(f"Error: File not found: {filepath}")
             return
         
@@ -154,7 +306,7 @@ class Matlab:
         
         # Run the command without timing for files
         self.run_code(code, run_timer=False)
-        logger.info(f"Running MATLAB file: {filepath}")
+        logger.info("Running MATLAB file: %s", filepath)
 
     def _prepare_command(self, code, run_timer=True):
         """Prepara el comando para enviar a Matlab."""
@@ -163,156 +315,297 @@ class Matlab:
             return "\n"  # Devolver una nueva línea para evitar bloqueos
             
         if run_timer:
-            # Generar un nombre de variable aleatorio para el temporizador
-            rand_var = ''.join(random.choice(string.ascii_uppercase) for _ in range(12))
-            command = ("{randvar}=tic;{code},try,toc({randvar}),catch,end"
-                      ",clear('{randvar}');\n").format(randvar=rand_var,
-                                                    code=code.strip())
+            # Generar un nombre de variable aleatorio para el temporizador;
+            # el f-string evita el analizador de str.format en cada comando
+            rand_var = _rand_var_name()
+            code_s = code.strip()
+            command = (f"{rand_var}=tic;{code_s},try,toc({rand_var}),catch,end"
+                       f",clear('{rand_var}');\n")
         else:
             command = "{}\n".format(code.strip())
 
-        # The maximum number of characters allowed on a single line in Matlab's CLI is 4096.
-        delim = ' ...\n'
-        line_size = 4095 - len(delim)
-        
-        # Dividir comandos largos en múltiples líneas
-        if len(command) > line_size:
-            parts = []
-            for i in range(0, len(command), line_size):
-                parts.append(command[i:i+line_size])
-            command = delim.join(parts)
-        
-        # Asegurar que el comando termina con nueva línea
-        if not command.endswith('\n'):
-            command += '\n'
-            
-        return command
+        # Camino corto: casi todos los comandos interactivos caben en una
+        # línea y no pagan el divisor. El límite de 4096 solo existe en la
+        # edición de línea del tty (pexpect); por tubería no aplica.
+        if len(command) <= _LINE_SIZE or not self._proc_uses_tty:
+            return command
+
+        # Dividir comandos largos en múltiples líneas: una lista en una sola
+        # asignación y un único join. El comando ya termina en '\n' (ambas
+        # ramas de arriba lo garantizan), así que el último trozo también.
+        return _SPLIT_DELIM.join([command[i:i + _LINE_SIZE]
+                                  for i in range(0, len(command), _LINE_SIZE)])
+
+    def _execute_command(self, payload):
+        """Ejecuta el comando preparado en Matlab.
+
+        ``payload`` es str con pexpect y el bytearray de envío reutilizable
+        (ya codificado) en el camino de stdin; _prepare_command garantiza
+        el '\\n' final en ambos casos.
 
-    def _execute_command(self, command):
-        """Ejecuta el comando preparado en Matlab."""
+        Un fallo de envío se propaga al llamador: relanzar Matlab es tarea
+        del hilo monitor, no de este camino.
+        """
         global hide_until_newline
-        num_retry = 0
-        
-        while num_retry < 3:
+        # El lock serializa frente a forward_input, el otro escritor del
+        # stdin de Matlab; kill()/cancel() solo usan os.kill y no lo tocan
+        with self._stdin_lock:
+            if use_pexpect:
+                hide_until_newline = True
+                self.proc.send(payload)
+            else:
+                # Un write(2) directo al fd: sin copia del BufferedWriter
+                # y sin flush aparte
+                _write_all(self._stdin_fd, payload)
+        logger.info("Command sent to Matlab successfully")
+
+
+# Despacho por prefijo: ambos prefijos miden 9 caracteres, así que un
+# solo slice msg[:9] indexa la tabla sin recorrer startswith por cada uno
+_PREFIX_DISPATCH = {
+    'run_file:': Matlab.run_file,
+    'run_cell:': Matlab.run_cell,
+}
+
+
+class _Client:
+    """Estado por conexión: el socket y los bytes sin frame completo."""
+    __slots__ = ('sock', 'address', 'pending')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.pending = bytearray()
+
+
+class MatlabServer:
+    """Servidor de un solo hilo basado en selectors (epoll/kqueue).
+
+    Un único bucle de eventos atiende el socket de escucha y todos los
+    clientes: sin hilo por conexión y sin rebotes del GIL en cada lectura.
+    """
+
+    def __init__(self):
+        self.matlab = None
+        self.sel = selectors.DefaultSelector()
+        self.listen_sock, self.address = self._create_listen_socket()
+        self.listen_sock.setblocking(False)
+        self.sel.register(self.listen_sock, selectors.EVENT_READ, 'accept')
+        # Par de sockets interno para despertar el select() al apagar
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self.sel.register(self._wake_r, selectors.EVENT_READ, 'wake')
+        self._running = True
+        self._closed = False
+
+    def _create_listen_socket(self):
+        """Crea el socket de escucha: AF_UNIX si es posible, TCP si no."""
+        if _SOCKET_PATH is not None:
             try:
-                if use_pexpect:
-                    hide_until_newline = True
-                    self.proc.send(command)
+                # Eliminar un socket viejo de una ejecución anterior
+                if os.path.exists(_SOCKET_PATH):
+                    os.unlink(_SOCKET_PATH)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.bind(_SOCKET_PATH)
+                # Solo el dueño puede hablar con su Matlab
+                os.chmod(_SOCKET_PATH, 0o600)
+                sock.listen(8)
+                logger.info("Listening on Unix socket %s", _SOCKET_PATH)
+                return sock, _SOCKET_PATH
+            except OSError as ex:
+                logger.warning("Unix socket unavailable (%s), using TCP", ex)
+
+        host, port = "localhost", 43889
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # SO_REUSEADDR basta para religar el puerto tras un reinicio pese
+        # al TIME_WAIT; SO_REUSEPORT además dejaría que un segundo servidor
+        # ligara el mismo puerto y el kernel repartiera las conexiones
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(8)
+        logger.info("Listening on %s:%s", host, port)
+        return sock, (host, port)
+
+    def serve_forever(self):
+        """Bucle de eventos: accept y lectura se despachan por readiness."""
+        while self._running:
+            for key, _mask in self.sel.select():
+                if key.data == 'accept':
+                    self._accept()
+                elif key.data == 'wake':
+                    # Solo sirve para salir del select()
+                    try:
+                        self._wake_r.recv(64)
+                    except OSError:
+                        pass
                 else:
-                    # Convertir a bytes antes de escribir
-                    if not command.endswith('\n'):
-                        command += '\n'
-                    self.proc.stdin.write(command.encode('utf-8'))
-                    self.proc.stdin.flush()  # Asegurar que el comando se envía inmediatamente
-                logger.info("Command sent to Matlab successfully")
-                break
-            except Exception as ex:
-                logger.error(f"Error sending command to Matlab: {ex}")
-                # Si falla el envío, intentar relanzar el proceso
-                if num_retry < 2:  # Solo reiniciar si no es el último intento
-                    logger.info("Attempting to restart Matlab process...")
-                    self.launch_process()
-                num_retry += 1
-                time.sleep(0.2)  # Reducido tiempo de espera
+                    self._service(key.data)
+        self.server_close()
 
+    def _accept(self):
+        try:
+            conn, addr = self.listen_sock.accept()
+        except OSError as ex:
+            logger.error("Accept failed: %s", ex)
+            return
+        conn.setblocking(False)
+        # Búferes grandes para que una celda entera quepa en un solo write
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        if conn.family == socket.AF_INET:
+            # Deshabilitar Nagle en el socket aceptado: cada mensaje es un
+            # comando pequeño y queremos que salga inmediatamente
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Detectar sesiones de Vim muertas sin quedarse colgados
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_QUICKACK'):
+                # Solo Linux: evitar también el retraso de ACK
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        client = _Client(conn, addr or 'local')
+        self.sel.register(conn, selectors.EVENT_READ, client)
+        logger.info("New connection: %s", client.address)
+        print_flush(f"New connection: {client.address}")
+
+    def _service(self, client):
+        """Lee lo disponible de un cliente y despacha sus frames completos."""
+        try:
+            chunk = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as ex:
+            logger.error("Connection error: %s", ex)
+            self._close_client(client)
+            return
 
-class TCPHandler(socketserver.StreamRequestHandler):
-    """Handle TCP connections from Vim."""
-    def handle(self):
-        logger.info(f"New connection: {self.client_address}")
-        print_flush(f"New connection: {self.client_address}")
+        if not chunk:
+            self._close_client(client)
+            return
 
-        while True:
+        # Protocolo con prefijo de longitud (4 bytes big-endian): una lectura
+        # del tamaño y una del cuerpo, sin escanear en busca de '\n', y los
+        # payloads (p. ej. celdas) pueden contener saltos de línea
+        pending = client.pending
+        pending += chunk
+        while len(pending) >= 4:
+            n = int.from_bytes(pending[:4], 'big')
+            if n > 16 * 1024 * 1024:
+                logger.error("Oversized frame (%d bytes), dropping client", n)
+                self._close_client(client)
+                return
+            if len(pending) < 4 + n:
+                break
+            payload = bytes(pending[4:4 + n])
+            del pending[:4 + n]
+
+            # Decodificar bytes a string
             try:
-                msg = self.rfile.readline()
-                if not msg:
-                    logger.info("Empty message received, ending connection")
-                    break
-                    
-                # Decodificar bytes a string
-                try:
-                    msg = msg.decode('utf-8').strip()
-                except UnicodeDecodeError:
-                    logger.error("Error decoding message, invalid UTF-8")
-                    continue
-                
-                # Logging con límite de tamaño para mensajes largos
-                log_msg = (msg[:74] + '...') if len(msg) > 74 else msg
-                logger.info(f"Received: {log_msg}")
-                print_flush(log_msg, end='')
+                msg = payload.decode('utf-8').strip()
+            except UnicodeDecodeError:
+                logger.error("Error decoding message, invalid UTF-8")
+                continue
 
-                # Procesar mensaje
+            # Logging con límite de tamaño para mensajes largos
+            log_msg = (msg[:74] + '...') if len(msg) > 74 else msg
+            logger.info("Received: %s", log_msg)
+            print_flush(log_msg, end='')
+
+            try:
                 self._process_message(msg)
-                
-            except ConnectionError as ex:
-                logger.error(f"Connection error: {ex}")
-                break
             except Exception as ex:
-                logger.error(f"Error handling message: {ex}")
-        
-        logger.info(f'Connection closed: {self.client_address}')
-        print_flush(f'Connection closed: {self.client_address}')
+                logger.error("Error handling message: %s", ex)
+
+    def _close_client(self, client):
+        try:
+            self.sel.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            client.sock.close()
+        except OSError:
+            pass
+        logger.info(f'Connection closed: {client.address}')
+        print_flush(f'Connection closed: {client.address}')
 
     def _process_message(self, msg):
         """Procesa el mensaje recibido."""
         options = {
-            'kill': self.server.matlab.kill,
-            'cancel': self.server.matlab.cancel,
+            'kill': self.matlab.kill,
+            'cancel': self.matlab.cancel,
         }
-        
-        # Verificar tipo de comando
-        if msg.startswith('run_file:'):
-            filepath = msg[9:]  # Extraer la ruta del archivo después de 'run_file:'
-            self.server.matlab.run_file(filepath)
-        elif msg.startswith('run_cell:'):
-            cell_code = msg[9:]  # Extraer código después de 'run_cell:'
-            self.server.matlab.run_cell(cell_code)
+
+        # Verificar tipo de comando: un slice + una búsqueda en la tabla
+        # de prefijos en lugar de un startswith por cada prefijo
+        handler = _PREFIX_DISPATCH.get(msg[:9])
+        if handler is not None:
+            handler(self.matlab, msg[9:])
         elif msg in options:
             options[msg]()
         else:
-            self.server.matlab.run_code(msg)
+            # Un frame de código puede agrupar varias líneas (lotes del
+            # controlador); cada una es un comando propio
+            for line in msg.split('\n'):
+                if line.strip():
+                    self.matlab.run_code(line)
+
+    def shutdown(self):
+        """Detiene el bucle de eventos (seguro desde otros hilos)."""
+        self._running = False
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def server_close(self):
+        """Cierra todos los sockets y el selector (idempotente)."""
+        if self._closed:
+            return
+        self._closed = True
+        for key in list(self.sel.get_map().values()):
+            if isinstance(key.data, _Client):
+                self._close_client(key.data)
+        try:
+            self.sel.unregister(self.listen_sock)
+        except (KeyError, ValueError):
+            pass
+        self.listen_sock.close()
+        self._wake_r.close()
+        self._wake_w.close()
+        self.sel.close()
 
 
 def status_monitor_thread(matlab):
     """Monitor Matlab process and restart if needed."""
     while True:
         try:
-            # Verificar si el proceso de Matlab está activo
-            if use_pexpect:
-                exit_status = matlab.proc.exitstatus
-                if exit_status is not None:
-                    # Proceso terminado
-                    if not auto_restart:
-                        logger.info("Matlab process terminated and auto-restart disabled")
-                        break
-                    logger.info("Restarting Matlab process...")
-                    print_flush("Restarting...")
-                    matlab.launch_process()
-                    start_thread(target=forward_input, args=(matlab,))
-            else:
-                if matlab.proc.poll() is not None:
-                    # Proceso terminado
-                    if not auto_restart:
-                        logger.info("Matlab process terminated and auto-restart disabled")
-                        break
-                    logger.info("Restarting Matlab process...")
-                    print_flush("Restarting...")
-                    matlab.launch_process()
-                    start_thread(target=forward_input, args=(matlab,))
-                    
-            time.sleep(0.5)  # Reduced wait time
+            # Espera bloqueante en el kernel hasta que el proceso termine:
+            # cero CPU mientras Matlab vive y reacción inmediata al salir.
+            # wait() usa waitpid y no lee del pty, así no compite con el
+            # interact() de forward_input por la salida de Matlab
+            matlab.proc.wait()
+
+            if not auto_restart:
+                logger.info("Matlab process terminated and auto-restart disabled")
+                break
+            logger.info("Restarting Matlab process...")
+            print_flush("Restarting...")
+            matlab.launch_process()
+            matlab.wait_until_ready()
+            start_thread(target=forward_input, args=(matlab,))
         except Exception as ex:
-            logger.error(f"Error in status monitor: {ex}")
+            logger.error("Error in status monitor: %s", ex)
             time.sleep(1)
 
     # Si salimos del bucle, el servidor debe cerrarse
+    matlab._enqueue(None)  # Terminar el hilo procesador de comandos
     global server
     try:
         server.shutdown()
         server.server_close()
+        if _SOCKET_PATH is not None and os.path.exists(_SOCKET_PATH):
+            os.unlink(_SOCKET_PATH)
         logger.info("Server shutdown")
     except Exception as ex:
-        logger.error(f"Error shutting down server: {ex}")
+        logger.error("Error shutting down server: %s", ex)
 
 
 def output_filter(output_string):
@@ -355,14 +648,15 @@ def forward_input(matlab):
                     logger.info("EOF detected in stdin")
                     break
                 
-                # Codificar la línea a bytes antes de escribirla
-                matlab.proc.stdin.write(line.encode('utf-8'))
-                matlab.proc.stdin.flush()  # Asegurar que la entrada se procesa inmediatamente
+                # Codificar la línea a bytes antes de escribirla; el lock
+                # evita intercalar la línea con un lote del hilo drenador
+                with matlab._stdin_lock:
+                    _write_all(matlab._stdin_fd, line.encode('utf-8'))
             except BrokenPipeError:
                 logger.error("Broken pipe in forward_input")
                 break
             except Exception as ex:
-                logger.error(f"Error in forward_input: {ex}")
+                logger.error("Error in forward_input: %s", ex)
                 time.sleep(0.2)
 
 
@@ -377,41 +671,39 @@ def start_thread(target=None, args=()):
 def print_flush(value, end='\n'):
     """Print and flush stdout."""
     if use_pexpect:
-        value += '\b' * len(value)
+        # CR + borrado de línea ANSI: 4 bytes constantes en lugar de
+        # len(value) retrocesos por mensaje
+        value = '\r\x1b[2K' + value
     try:
-        sys.stdout.write(value + end)
-        sys.stdout.flush()
+        # Una sola llamada en C en lugar de concatenar + write + flush
+        print(value, end=end, flush=True)
     except Exception as ex:
-        logger.error(f"Error in print_flush: {ex}")
+        logger.error("Error in print_flush: %s", ex)
 
 
 def main():
     """Main function to start the server."""
-    host, port = "localhost", 43889
-    socketserver.TCPServer.allow_reuse_address = True
-
     global server
-    logger.info(f"Starting server on {host}:{port}")
-    
+
     try:
-        server = socketserver.TCPServer((host, port), TCPHandler)
+        server = MatlabServer()
         server.matlab = Matlab()
 
         start_thread(target=forward_input, args=(server.matlab,))
         start_thread(target=status_monitor_thread, args=(server.matlab,))
 
-        print_flush(f"Started server: {(host, port)}")
+        print_flush(f"Started server: {server.address}")
         server.serve_forever()
     except OSError as ex:
         if "Address already in use" in str(ex):
-            logger.error(f"Port {port} already in use. Is the server already running?")
-            print_flush(f"Error: Port {port} already in use. Is the server already running?")
+            logger.error("Address already in use. Is the server already running?")
+            print_flush("Error: Address already in use. Is the server already running?")
         else:
-            logger.error(f"OS error starting server: {ex}")
+            logger.error("OS error starting server: %s", ex)
             print_flush(f"Error starting server: {ex}")
         sys.exit(1)
     except Exception as ex:
-        logger.error(f"Error starting server: {ex}")
+        logger.error("Error starting server: %s", ex)
         print_flush(f"Error starting server: {ex}")
         sys.exit(1)
 
@@ -55,7 +55,7 @@ function! s:InitController()
 import matlab_cli_controller
 controller = None
 try:
-    controller = matlab_cli_controller.MatlabCliController()
+    controller = matlab_cli_controller.get_controller()
     print("Matlab controller initialized")
 except Exception as e:
     print(f"Error initializing Matlab controller: {e}")